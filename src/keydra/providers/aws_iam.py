@@ -1,8 +1,20 @@
-from typing import FrozenSet, List
+import functools
+import hashlib
+import json
+import logging
+import threading
+
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Dict, FrozenSet, List
 import boto3
 import boto3.session
 
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from botocore.exceptions import WaiterError
+from mypy_boto3_iam.type_defs import AccessKeyMetadataTypeDef
 from mypy_boto3_iam.type_defs import TagTypeDef
 
 from keydra.providers.base import BaseProvider
@@ -19,6 +31,25 @@ LOGGER = get_logger()
 
 PW_FIELD = 'secret'
 
+MANAGED_TAG = ('managedby', 'keydra')
+FINGERPRINT_TAG = 'keydra:fingerprint'
+
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 5}
+)
+
+MAX_WORKERS = 8
+
+_ALLOWED_OPTIONS = {'tags': dict, 'groups': list, 'policies': list}
+_ALLOWED_KEYS = frozenset(_ALLOWED_OPTIONS)
+
+_THREAD_LOCAL = threading.local()
+
+
+class _ConcurrentModification(ClientError):
+    pass
+
 
 def _explain_secret(aws_secret):
     return {
@@ -28,43 +59,84 @@ def _explain_secret(aws_secret):
     }
 
 
+# STS clients are built from the same session as the IAM client, so the
+# credentials match, and only once per session as client creation is costly
+@functools.lru_cache(maxsize=16)
+def _sts_client(session):
+    return session.client('sts', config=BOTO_CONFIG)
+
+
+def _default_session():
+    # Sessions are cached per thread, as they are not safe to share for
+    # client creation across threads
+    if getattr(_THREAD_LOCAL, 'session', None) is None:
+        _THREAD_LOCAL.session = boto3.session.Session()
+
+    return _THREAD_LOCAL.session
+
+
+def _tag_set(tags):
+    return frozenset((t['Key'], t['Value']) for t in tags)
+
+
+def _config_fingerprint(groups, policies):
+    if not isinstance(groups, list):
+        groups = [groups]
+
+    return hashlib.sha256(
+        json.dumps([sorted(set(groups)), sorted(policies)]).encode()
+    ).hexdigest()
+
+
+# The account id never changes for a given set of credentials, so resolve it
+# once per process (and session) rather than once per Client instance
+@functools.lru_cache(maxsize=16)
+def _resolve_account_id(session) -> str:
+    return _sts_client(session).get_caller_identity()['Account']
+
+
 class Client(BaseProvider):
     def __init__(self, session=None, region_name=None, credentials=None):
         if session is None:
-            session = boto3.session.Session()
+            session = _default_session()
 
-        self._client: IAMClient = session.client('iam')
-        self._account_id = None
+        self._client: IAMClient = session.client('iam', config=BOTO_CONFIG)
+        self._session = session
+        self._policy_arn_prefix = None
 
     def _get_aws_account_id(self) -> str:
-        if self._account_id is None:
-            self._account_id = boto3.client(
-                'sts').get_caller_identity().get('Account')
+        return _resolve_account_id(self._session)
 
-        return self._account_id
+    def _get_policy_arn_prefix(self) -> str:
+        if self._policy_arn_prefix is None:
+            self._policy_arn_prefix = \
+                f'arn:aws:iam::{self._get_aws_account_id()}:policy/'
 
-    def _fetch_access_keys(self, user):
+        return self._policy_arn_prefix
+
+    def _fetch_access_keys(self, user) -> Dict[str, "AccessKeyMetadataTypeDef"]:
         LOGGER.info('Fetching user keys')
 
         keys_by_id = {
-            x['AccessKeyId']: x for x in self._client.list_access_keys(
+            x['AccessKeyId']: x for x in self._client.get_paginator(
+                'list_access_keys'
+            ).paginate(
                 UserName=user
-            )['AccessKeyMetadata']
+            ).build_full_result()['AccessKeyMetadata']
         }
 
-        LOGGER.info(
-            {
-                'message': 'Available keys: {}'.format(
-                    ', '.join(
-                        [
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info(
+                {
+                    'message': 'Available keys: {}'.format(
+                        ', '.join(
                             '{} ({})'.format(x['AccessKeyId'], x['Status'])
                             for x in keys_by_id.values()
-                        ]
-                    )
-                ),
-                'data': list(keys_by_id.values())
-            }
-        )
+                        )
+                    ),
+                    'data': list(keys_by_id.values())
+                }
+            )
 
         return keys_by_id
 
@@ -74,54 +146,70 @@ class Client(BaseProvider):
         candidate = None
         reason = None
 
-        for kid, key in keys_by_id.items():
-            key['last_used'] = self._client.get_access_key_last_used(
-                AccessKeyId=kid
-            )['AccessKeyLastUsed'].get('LastUsedDate')
-
-            # The inactive key is always the best option for rotation
+        # The inactive key is always the best option for rotation, no need to
+        # look up when the keys were last used
+        for key in keys_by_id.values():
             if key['Status'] != 'Active':
                 candidate = key
                 reason = 'inactive'
                 break
 
-            if candidate is None:
-                candidate = key
-                reason = 'initial_option'
+        if candidate is None:
+            get_last_used = self._client.get_access_key_last_used
 
-            if key['last_used'] is None or candidate['last_used'] is None:
-                continue
+            with ThreadPoolExecutor(
+                max_workers=len(keys_by_id) or 1
+            ) as executor:
+                futures = {
+                    executor.submit(get_last_used, AccessKeyId=kid): kid
+                    for kid in keys_by_id
+                }
 
-            # Older keys have preference
-            if key['last_used'] < candidate['last_used']:
-                candidate = key
-                reason = 'last_used'
+                for future in as_completed(futures):
+                    last_used = future.result()['AccessKeyLastUsed']
+                    keys_by_id[futures[future]]['last_used'] = last_used.get(
+                        'LastUsedDate')
+
+            candidate_last_used = None
+
+            for key in keys_by_id.values():
+                key_last_used = key['last_used']
+
+                if candidate is None:
+                    candidate = key
+                    candidate_last_used = key_last_used
+                    reason = 'initial_option'
+
+                if key_last_used is None or candidate_last_used is None:
+                    continue
+
+                # Older keys have preference
+                if key_last_used < candidate_last_used:
+                    candidate = key
+                    candidate_last_used = key_last_used
+                    reason = 'last_used'
 
         LOGGER.info(
-            'Key {} elected for rotation. Reason: {}'.format(
-                candidate,
-                reason
-            )
+            'Key %s elected for rotation. Reason: %s', candidate, reason
         )
 
         return candidate
 
     def _create_access_key(self, user):
-        LOGGER.info('Creating new secreds for: {}'.format(user))
+        LOGGER.info('Creating new secreds for: %s', user)
 
         new_creds = self._client.create_access_key(UserName=user)
 
         LOGGER.info(
-            'New secrets for {} successfully created: {}'.format(
-                user,
-                new_creds['AccessKey']['AccessKeyId']
-            )
+            'New secrets for %s successfully created: %s',
+            user,
+            new_creds['AccessKey']['AccessKeyId']
         )
 
         return new_creds['AccessKey']
 
     def _delete_access_key(self, user, key_id):
-        LOGGER.info('Deleting key: {}'.format(key_id))
+        LOGGER.info('Deleting key: %s', key_id)
 
         self._client.delete_access_key(
             AccessKeyId=key_id,
@@ -131,7 +219,7 @@ class Client(BaseProvider):
     def _update_access_key(self, user, key_id, active):
         active_string = 'Active' if active else 'Inactive'
 
-        LOGGER.info('Updating key {}: {}'.format(key_id, active_string))
+        LOGGER.info('Updating key %s: %s', key_id, active_string)
 
         self._client.update_access_key(
             AccessKeyId=key_id,
@@ -140,28 +228,28 @@ class Client(BaseProvider):
         )
 
     def _create_user_if_not_available(self, iam_user, options=None):
-        expected_tags: List["TagTypeDef"] = [{
-            'Key': 'managedby',
-            'Value': 'keydra'
-        }]
+        user_tags = (options or {}).get('tags') or {}
 
-        if options and options.get('tags'):
-            for k, v in options.get('tags').items():
-                expected_tags.append({'Key': k, 'Value': v})
+        expected_tags: List["TagTypeDef"] = [
+            {'Key': MANAGED_TAG[0], 'Value': MANAGED_TAG[1]},
+            *({'Key': k, 'Value': v} for k, v in user_tags.items())
+        ]
 
         try:
             existing_user = self._client.get_user(UserName=iam_user)
 
-            if existing_user['User'].get('Tags') != expected_tags:
+            # tag_user only adds or overwrites, so there is nothing to do when
+            # all expected tags are already there, whatever their order
+            existing_tags = existing_user['User'].get('Tags', [])
+
+            if not _tag_set(expected_tags) <= _tag_set(existing_tags):
                 self._client.tag_user(UserName=iam_user,
                                       Tags=expected_tags)
 
-            return
+            return existing_tags
         except ClientError:
-            LOGGER.warn(
-                'User "{}" does not exist, attempting to create.'.format(
-                    iam_user
-                )
+            LOGGER.warning(
+                'User "%s" does not exist, attempting to create.', iam_user
             )
 
         self._client.create_user(
@@ -169,7 +257,19 @@ class Client(BaseProvider):
             Tags=expected_tags
         )
 
-        LOGGER.info('User "{}" created successfully.'.format(iam_user))
+        # IAM is eventually consistent, make sure the user is visible before
+        # carrying on with the rotation
+        try:
+            self._client.get_waiter('user_exists').wait(
+                UserName=iam_user,
+                WaiterConfig={'Delay': 1, 'MaxAttempts': 10}
+            )
+        except WaiterError as e:
+            raise RotationException(e)
+
+        LOGGER.info('User "%s" created successfully.', iam_user)
+
+        return []
 
     def _update_user_group_membership(self, iam_user, groups):
         if not isinstance(groups, list):
@@ -179,118 +279,200 @@ class Client(BaseProvider):
         current_groups = set([])
 
         try:
-            for group in self._client.list_groups_for_user(
+            for group in self._client.get_paginator(
+                'list_groups_for_user'
+            ).paginate(
                 UserName=iam_user
-            ).get('Groups', []):
+            ).build_full_result().get('Groups', []):
                 current_groups.add(group['GroupName'])
 
         except ClientError as e:  # pragma: no cover
-            LOGGER.warn(
-                'Not able to list groups for user "{}": {}'.format(iam_user, e)
+            LOGGER.warning(
+                'Not able to list groups for user "%s": %s', iam_user, e
             )
 
-            return
+            return False
 
-        group_set = current_groups | rightful_groups
+        to_remove = current_groups - rightful_groups
+        to_add = rightful_groups - current_groups
 
-        for group in group_set - rightful_groups:
-            try:
-                self._client.remove_user_from_group(
-                    UserName=iam_user,
-                    GroupName=group
-                )
+        if not to_remove and not to_add:
+            return True
 
-                LOGGER.info(
-                    'Removed user "{}" from group "{}"'.format(iam_user, group)
-                )
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Remove before adding, so the user is only changed one way at a
+            # time
+            removed = list(executor.map(
+                functools.partial(self._remove_user_from_group, iam_user),
+                to_remove
+            ))
 
-            except ClientError as e:  # pragma: no cover
-                LOGGER.warn(
-                    'Not able to remove user "{}" from group "{}": {}'.format(
-                        iam_user, group, e
-                    )
-                )
+            added = list(executor.map(
+                functools.partial(self._add_user_to_group, iam_user),
+                to_add
+            ))
 
-        for group in group_set - current_groups:
-            try:
-                self._client.add_user_to_group(
-                    UserName=iam_user,
-                    GroupName=group
-                )
+        return all(removed) and all(added)
 
-                LOGGER.info(
-                    'Added user "{}" to group "{}"'.format(iam_user, group)
-                )
+    @exponential_backoff_retry(3, exception_type=_ConcurrentModification)
+    def _modify_user(self, operation, **kwargs):
+        try:
+            operation(**kwargs)
+        except ClientError as e:
+            # Concurrent changes to the same user are transient, retry them
+            if e.response.get('Error', {}).get('Code') == \
+                    'ConcurrentModification':
+                raise _ConcurrentModification(e.response, e.operation_name)
 
-            except ClientError as e:  # pragma: no cover
-                LOGGER.warn(
-                    'Not able to add user "{}" to group "{}": {}'
-                    .format(
-                        iam_user, group, e
-                    )
-                )
+            raise
+
+    def _remove_user_from_group(self, iam_user, group):
+        try:
+            self._modify_user(
+                self._client.remove_user_from_group,
+                UserName=iam_user,
+                GroupName=group
+            )
+
+            LOGGER.info('Removed user "%s" from group "%s"', iam_user, group)
+
+            return True
+
+        except ClientError as e:  # pragma: no cover
+            LOGGER.warning(
+                'Not able to remove user "%s" from group "%s": %s',
+                iam_user, group, e
+            )
+
+            return False
+
+    def _add_user_to_group(self, iam_user, group):
+        try:
+            self._modify_user(
+                self._client.add_user_to_group,
+                UserName=iam_user,
+                GroupName=group
+            )
+
+            LOGGER.info('Added user "%s" to group "%s"', iam_user, group)
+
+            return True
 
-    def _make_policy_arn(self, policy_name_with_path: str) -> str:
-        return f'arn:aws:iam::{self._get_aws_account_id()}:policy/{policy_name_with_path}'
+        except ClientError as e:
+            LOGGER.warning(
+                'Not able to add user "%s" to group "%s": %s',
+                iam_user, group, e
+            )
+
+            return False
 
     def _detach_policy_from_user(self, policy_arn: str, username: str):
         try:
-            self._client.detach_user_policy(
+            self._modify_user(
+                self._client.detach_user_policy,
                 UserName=username,
-                PolicyArn=policy_arn)
+                PolicyArn=policy_arn
+            )
 
             LOGGER.info(
-                f'Detached policy {policy_arn} from user {username}')
+                'Detached policy %s from user %s', policy_arn, username)
+
+            return True
         except ClientError as e:  # pragma: no cover
-            LOGGER.warn(
-                    f'Failed detaching policy {policy_arn} from user {username}: {e}')
+            LOGGER.warning(
+                'Failed detaching policy %s from user %s: %s',
+                policy_arn, username, e)
+
+            return False
 
     def _attach_policy_to_user(self, policy_arn: str, username: str):
         try:
-            self._client.attach_user_policy(
+            self._modify_user(
+                self._client.attach_user_policy,
                 UserName=username,
-                PolicyArn=policy_arn)
+                PolicyArn=policy_arn
+            )
 
             LOGGER.info(
-                f'Attached policy {policy_arn} to user {username}')
-        except ClientError as e:  # pragma: no cover
-            LOGGER.warn(
-                    f'Failed attaching policy {policy_arn} to user {username}: {e}')
+                'Attached policy %s to user %s', policy_arn, username)
+
+            return True
+        except ClientError as e:
+            LOGGER.warning(
+                'Failed attaching policy %s to user %s: %s',
+                policy_arn, username, e)
+
+            return False
 
     def _update_user_policies(
             self, username, expected_policies: FrozenSet[str]):
 
-        expected_policy_arns: FrozenSet[str] = frozenset({
-            self._make_policy_arn(p) for p in expected_policies})
+        expected_policy_arns: FrozenSet[str] = frozenset()
+
+        # Only resolve the account id when there are policies to expect
+        if expected_policies:
+            prefix = self._get_policy_arn_prefix()
+
+            expected_policy_arns = frozenset(
+                prefix + p for p in expected_policies)
 
         LOGGER.debug(
-            f'Expected policies for IAM user {username}: {expected_policy_arns}')
+            'Expected policies for IAM user %s: %s',
+            username, expected_policy_arns)
 
         try:
             current_policy_arns: FrozenSet[str] = frozenset([
                 p.get('PolicyArn', None)
-                for p in self._client.list_attached_user_policies(
-                    UserName=username)['AttachedPolicies']])
+                for p in self._client.get_paginator(
+                    'list_attached_user_policies').paginate(
+                    UserName=username).build_full_result()['AttachedPolicies']])
         except ClientError as e:  # pragma: no cover
-            LOGGER.warn(
-                f'Failed to fetch managed policies attached to IAM user {username}: {e}')
-            return
+            LOGGER.warning(
+                'Failed to fetch managed policies attached to IAM user %s: %s',
+                username, e)
+            return False
 
         LOGGER.debug(
-            f'Current policies for IAM user {username}: {current_policy_arns}')
-
-        union_policy_arns = expected_policy_arns | current_policy_arns
-
-        for policy_arn in union_policy_arns - current_policy_arns:
-            self._attach_policy_to_user(policy_arn, username)
+            'Current policies for IAM user %s: %s',
+            username, current_policy_arns)
+
+        if expected_policy_arns == current_policy_arns:
+            return True
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Detach before attaching, so the user is only changed one way
+            # at a time
+            detached = list(executor.map(
+                functools.partial(
+                    self._detach_policy_from_user, username=username),
+                current_policy_arns - expected_policy_arns
+            ))
+
+            attached = list(executor.map(
+                functools.partial(
+                    self._attach_policy_to_user, username=username),
+                expected_policy_arns - current_policy_arns
+            ))
+
+        return all(detached) and all(attached)
+
+    def _tag_config_fingerprint(self, iam_user, fingerprint):
+        try:
+            self._client.tag_user(
+                UserName=iam_user,
+                Tags=[{'Key': FINGERPRINT_TAG, 'Value': fingerprint}]
+            )
 
-        for policy_arn in union_policy_arns - expected_policy_arns:
-            self._detach_policy_from_user(policy_arn, username)
+        except ClientError as e:
+            LOGGER.warning(
+                'Not able to tag config fingerprint on user "%s": %s',
+                iam_user, e
+            )
 
     @exponential_backoff_retry(3)
     def rotate(self, secret):
         try:
-            self._create_user_if_not_available(
+            existing_tags = self._create_user_if_not_available(
                 secret['key'], secret.get('config'))
 
             keys_by_id = self._fetch_access_keys(secret['key'])
@@ -309,7 +491,7 @@ class Client(BaseProvider):
 
             # Let's make the current key inactive, so it is the last one to go
             if len(keys_by_id) == 1:
-                r_candidate = list(keys_by_id.values())[0]
+                r_candidate = next(iter(keys_by_id.values()))
 
                 self._update_access_key(
                     user=r_candidate['UserName'],
@@ -317,12 +499,30 @@ class Client(BaseProvider):
                     active=False
                 )
 
-            self._update_user_group_membership(
-                secret['key'], secret.get('config', {}).get('groups', [])
-            )
+            groups = secret.get('config', {}).get('groups', [])
+            policies = frozenset(secret.get('config', {}).get('policies', []))
 
-            self._update_user_policies(secret['key'], frozenset(secret.get(
-                'config', {}).get('policies', [])))
+            # Groups and policies were synced on a previous rotation and the
+            # config hasn't changed since, skip listing and diffing them
+            fingerprint = _config_fingerprint(groups, policies)
+
+            if {MANAGED_TAG, (FINGERPRINT_TAG, fingerprint)} <= \
+                    _tag_set(existing_tags):
+                LOGGER.info(
+                    'Groups and policies of user "%s" are up to date',
+                    secret['key']
+                )
+
+            else:
+                groups_synced = self._update_user_group_membership(
+                    secret['key'], groups)
+                policies_synced = self._update_user_policies(
+                    secret['key'], policies)
+
+                # Only record the fingerprint when everything was applied, so
+                # failed changes are retried on the next rotation
+                if groups_synced and policies_synced:
+                    self._tag_config_fingerprint(secret['key'], fingerprint)
 
             return _explain_secret(self._create_access_key(secret['key']))
 
@@ -348,14 +548,12 @@ class Client(BaseProvider):
             if 'config' not in spec:
                 return True, 'All good!'
 
-            allowed_options = {'tags': dict, 'groups': list, 'policies': list}
-
-            for oname, otype in allowed_options.items():
+            for oname, otype in _ALLOWED_OPTIONS.items():
                 provided_option = spec['config'].get(oname)
-                if provided_option and not type(provided_option) == otype:
+                if provided_option and not isinstance(provided_option, otype):
                     return False, '{} must be a {}'.format(oname, otype)
 
-            unknown_vals = spec['config'].keys() - allowed_options.keys()
+            unknown_vals = spec['config'].keys() - _ALLOWED_KEYS
 
             if unknown_vals:
                 return (False,
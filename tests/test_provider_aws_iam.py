@@ -1,6 +1,8 @@
+import logging
 import unittest
 
 from botocore.exceptions import ClientError
+from botocore.exceptions import WaiterError
 
 from datetime import datetime
 from datetime import timedelta
@@ -8,6 +10,7 @@ from datetime import timedelta
 from keydra.providers import aws_iam
 
 from keydra.exceptions import DistributionException
+from keydra.exceptions import RotationException
 
 from unittest.mock import call
 from unittest.mock import MagicMock
@@ -48,7 +51,20 @@ class TestProviderAWSIAM(unittest.TestCase):
         cli._client = MagicMock()
 
         cli._fetch_access_keys('user')
-        cli._client.list_access_keys.assert_called_once_with(UserName='user')
+        cli._client.get_paginator.assert_called_once_with('list_access_keys')
+        cli._client.get_paginator().paginate.assert_called_once_with(
+            UserName='user')
+
+    @patch.object(aws_iam, 'LOGGER')
+    def test__fetch_access_key_logging_disabled(self, logger):
+        cli = aws_iam.Client(session=MagicMock())
+        cli._client = MagicMock()
+        logger.isEnabledFor.return_value = False
+
+        cli._fetch_access_keys('user')
+
+        logger.isEnabledFor.assert_called_once_with(logging.INFO)
+        logger.info.assert_called_once_with('Fetching user keys')
 
     def test__pick_best_candidate_just_one_key(self):
         cli = aws_iam.Client(session=MagicMock())
@@ -70,7 +86,7 @@ class TestProviderAWSIAM(unittest.TestCase):
 
         candidate = cli._pick_best_candidate(keys_by_id)
 
-        cli._client.get_access_key_last_used.has_calls(
+        cli._client.get_access_key_last_used.assert_has_calls(
             [
                 call(AccessKeyId='KEY_ONE'),
             ]
@@ -100,12 +116,7 @@ class TestProviderAWSIAM(unittest.TestCase):
 
         candidate = cli._pick_best_candidate(keys_by_id)
 
-        cli._client.get_access_key_last_used.has_calls(
-            [
-                call(AccessKeyId='KEY_ONE'),
-                call(AccessKeyId='KEY_TWO'),
-            ]
-        )
+        cli._client.get_access_key_last_used.assert_not_called()
 
         self.assertEqual(candidate['AccessKeyId'], 'KEY_ONE')
 
@@ -125,18 +136,22 @@ class TestProviderAWSIAM(unittest.TestCase):
         now = datetime.now()
         now_plus = now + timedelta(hours=1)
 
-        cli._client.get_access_key_last_used.side_effect = [
-            {'AccessKeyLastUsed': {'LastUsedDate': now_plus}},
-            {'AccessKeyLastUsed': {'LastUsedDate': now}},
-        ]
+        last_used = {
+            'KEY_ONE': {'AccessKeyLastUsed': {'LastUsedDate': now_plus}},
+            'KEY_TWO': {'AccessKeyLastUsed': {'LastUsedDate': now}},
+        }
+
+        cli._client.get_access_key_last_used.side_effect = \
+            lambda AccessKeyId: last_used[AccessKeyId]
 
         candidate = cli._pick_best_candidate(keys_by_id)
 
-        cli._client.get_access_key_last_used.has_calls(
+        cli._client.get_access_key_last_used.assert_has_calls(
             [
                 call(AccessKeyId='KEY_ONE'),
                 call(AccessKeyId='KEY_TWO'),
-            ]
+            ],
+            any_order=True
         )
 
         self.assertEqual(candidate['AccessKeyId'], 'KEY_TWO')
@@ -156,18 +171,22 @@ class TestProviderAWSIAM(unittest.TestCase):
 
         now = datetime.now()
 
-        cli._client.get_access_key_last_used.side_effect = [
-            {'AccessKeyLastUsed': {}},
-            {'AccessKeyLastUsed': {'LastUsedDate': now}},
-        ]
+        last_used = {
+            'KEY_ONE': {'AccessKeyLastUsed': {}},
+            'KEY_TWO': {'AccessKeyLastUsed': {'LastUsedDate': now}},
+        }
+
+        cli._client.get_access_key_last_used.side_effect = \
+            lambda AccessKeyId: last_used[AccessKeyId]
 
         candidate = cli._pick_best_candidate(keys_by_id)
 
-        cli._client.get_access_key_last_used.has_calls(
+        cli._client.get_access_key_last_used.assert_has_calls(
             [
                 call(AccessKeyId='KEY_ONE'),
                 call(AccessKeyId='KEY_TWO'),
-            ]
+            ],
+            any_order=True
         )
 
         self.assertEqual(candidate['AccessKeyId'], 'KEY_ONE')
@@ -237,6 +256,28 @@ class TestProviderAWSIAM(unittest.TestCase):
             UserName='user',
             Tags=[{'Key': 'managedby', 'Value': 'keydra'}]
         )
+        cli._client.get_waiter.assert_called_once_with('user_exists')
+        cli._client.get_waiter().wait.assert_called_once_with(
+            UserName='user',
+            WaiterConfig={'Delay': 1, 'MaxAttempts': 10}
+        )
+
+    def test__create_user_if_not_available_wait_times_out(self):
+        cli = aws_iam.Client(session=MagicMock())
+        cli._client = MagicMock()
+
+        cli._client.get_user.side_effect = ClientError(
+            error_response={},
+            operation_name=''
+        )
+        cli._client.get_waiter().wait.side_effect = WaiterError(
+            name='UserExists',
+            reason='Max attempts exceeded',
+            last_response={}
+        )
+
+        with self.assertRaises(RotationException):
+            cli._create_user_if_not_available('user')
 
     def test__create_user_with_tags(self):
         cli = aws_iam.Client(session=MagicMock())
@@ -303,11 +344,31 @@ class TestProviderAWSIAM(unittest.TestCase):
         cli._client.create_user.assert_not_called()
         cli._client.tag_user.assert_not_called()
 
+    def test__create_does_nothing_on_reordered_tags(self):
+        cli = aws_iam.Client(session=MagicMock())
+        cli._client = MagicMock()
+
+        cli._client.get_user.return_value = {
+            'User': {
+                'UserName': 'bananas',
+                'Tags': [
+                    {'Key': 'x', 'Value': '1'},
+                    {'Key': 'managedby', 'Value': 'keydra'}
+                ]
+            }
+        }
+
+        cli._create_user_if_not_available(
+            'user', options={'tags': {'x': '1'}})
+
+        cli._client.create_user.assert_not_called()
+        cli._client.tag_user.assert_not_called()
+
     def test__update_user_group_membership_no_existing_groups(self):
         cli = aws_iam.Client(session=MagicMock())
         cli._client = MagicMock()
 
-        cli._client.list_groups_for_user.return_value = {'Groups': []}
+        cli._client.get_paginator().paginate().build_full_result.return_value = {'Groups': []}
 
         cli._update_user_group_membership('usr', ['G1'])
 
@@ -322,12 +383,13 @@ class TestProviderAWSIAM(unittest.TestCase):
         cli = aws_iam.Client(session=MagicMock())
         cli._client = MagicMock()
 
-        cli._client.list_groups_for_user.return_value = {
+        cli._client.get_paginator().paginate().build_full_result.return_value = {
             'Groups': [{'GroupName': 'G2'}]
         }
 
         cli._update_user_group_membership('usr', ['G1'])
 
+        cli._client.get_paginator.assert_called_with('list_groups_for_user')
         cli._client.add_user_to_group.assert_has_calls(
             [
                 call(UserName='usr', GroupName='G1'),
@@ -339,17 +401,65 @@ class TestProviderAWSIAM(unittest.TestCase):
             UserName='usr', GroupName='G2'
         )
 
+    def test__update_user_group_membership_unchanged(self):
+        cli = aws_iam.Client(session=MagicMock())
+        cli._client = MagicMock()
+
+        cli._client.get_paginator().paginate().build_full_result.return_value = {
+            'Groups': [{'GroupName': 'G1'}]
+        }
+
+        self.assertTrue(cli._update_user_group_membership('usr', ['G1']))
+
+        cli._client.add_user_to_group.assert_not_called()
+        cli._client.remove_user_from_group.assert_not_called()
+
+    @patch('keydra.providers.base.time.sleep')
+    def test__update_user_group_membership_retries_concurrent_modification(
+            self, sleep):
+        cli = aws_iam.Client(session=MagicMock())
+        cli._client = MagicMock()
+
+        cli._client.get_paginator().paginate().build_full_result.return_value = {
+            'Groups': [{'GroupName': 'G2'}]
+        }
+        cli._client.add_user_to_group.side_effect = [
+            ClientError(
+                error_response={'Error': {'Code': 'ConcurrentModification'}},
+                operation_name='AddUserToGroup'
+            ),
+            {}
+        ]
+
+        manager = MagicMock()
+        manager.attach_mock(cli._client.remove_user_from_group, 'remove')
+        manager.attach_mock(cli._client.add_user_to_group, 'add')
+
+        cli._update_user_group_membership('usr', ['G1'])
+
+        self.assertEqual(
+            manager.mock_calls,
+            [
+                call.remove(UserName='usr', GroupName='G2'),
+                call.add(UserName='usr', GroupName='G1'),
+                call.add(UserName='usr', GroupName='G1'),
+            ]
+        )
+        sleep.assert_called_once()
+
     @patch.object(aws_iam.Client, '_get_aws_account_id')
     def test__update_user_policies_not_current(self, gaad):
         provider = aws_iam.Client(session=MagicMock())
         provider._client = MagicMock()
         gaad.return_value = '12345'
 
-        provider._client.list_attached_user_policies.return_value = {
+        provider._client.get_paginator().paginate().build_full_result.return_value = {
             'AttachedPolicies': []}
 
         provider._update_user_policies('usr', frozenset({'test/my_policy'}))
 
+        provider._client.get_paginator.assert_called_with(
+            'list_attached_user_policies')
         provider._client.attach_user_policy.assert_has_calls(
             [call(UserName='usr', PolicyArn='arn:aws:iam::12345:policy/test/my_policy')])
 
@@ -361,7 +471,7 @@ class TestProviderAWSIAM(unittest.TestCase):
         provider._client = MagicMock()
         gaad.return_value = '12345'
 
-        provider._client.list_attached_user_policies.return_value = {
+        provider._client.get_paginator().paginate().build_full_result.return_value = {
             'AttachedPolicies': [{'PolicyArn': 'arn:aws:iam::12345:policy/test/my_policy'}]}
 
         provider._update_user_policies('usr', frozenset())
@@ -371,20 +481,46 @@ class TestProviderAWSIAM(unittest.TestCase):
 
         provider._client.attach_user_policy.assert_not_called()
 
+    @patch.object(aws_iam, 'ThreadPoolExecutor')
     @patch.object(aws_iam.Client, '_get_aws_account_id')
-    def test__update_user_policies_current_expected(self, gaad):
+    def test__update_user_policies_current_expected(self, gaad, tpe):
         provider = aws_iam.Client(session=MagicMock())
         provider._client = MagicMock()
         gaad.return_value = '12345'
 
-        provider._client.list_attached_user_policies.return_value = {
+        provider._client.get_paginator().paginate().build_full_result.return_value = {
             'AttachedPolicies': [{'PolicyArn': 'arn:aws:iam::12345:policy/test/my_policy'}]}
 
         provider._update_user_policies('usr', frozenset({'test/my_policy'}))
 
+        tpe.assert_not_called()
         provider._client.detach_user_policy.assert_not_called()
         provider._client.attach_user_policy.assert_not_called()
 
+    @patch('keydra.providers.base.time.sleep')
+    @patch.object(aws_iam.Client, '_get_aws_account_id')
+    def test__update_user_policies_retries_concurrent_modification(
+            self, gaad, sleep):
+        provider = aws_iam.Client(session=MagicMock())
+        provider._client = MagicMock()
+        gaad.return_value = '12345'
+
+        provider._client.get_paginator().paginate().build_full_result.return_value = {
+            'AttachedPolicies': []}
+        provider._client.attach_user_policy.side_effect = [
+            ClientError(
+                error_response={'Error': {'Code': 'ConcurrentModification'}},
+                operation_name='AttachUserPolicy'
+            ),
+            {}
+        ]
+
+        provider._update_user_policies('usr', frozenset({'test/my_policy'}))
+
+        provider._client.attach_user_policy.assert_has_calls(
+            [call(UserName='usr', PolicyArn='arn:aws:iam::12345:policy/test/my_policy')] * 2)
+        sleep.assert_called_once()
+
     @ patch.object(aws_iam.Client, '_fetch_access_keys')
     @ patch.object(aws_iam.Client, '_pick_best_candidate')
     @ patch.object(aws_iam.Client, '_delete_access_key')
@@ -424,12 +560,127 @@ class TestProviderAWSIAM(unittest.TestCase):
         )
         mk_uugm.assert_called_once_with('U', ['G'])
         mk_cak.assert_called_once_with('U')
+        cli._client.tag_user.assert_called_with(
+            UserName='U',
+            Tags=[{
+                'Key': aws_iam.FINGERPRINT_TAG,
+                'Value': aws_iam._config_fingerprint(['G'], frozenset())
+            }]
+        )
 
         self.assertEqual(
             creds,
             {'provider': 'iam', 'key': 'KEY_ONE', 'secret': 'new_secret'}
         )
 
+    @patch.object(aws_iam.Client, '_create_user_if_not_available')
+    @patch.object(aws_iam.Client, '_fetch_access_keys')
+    @patch.object(aws_iam.Client, '_update_user_group_membership')
+    @patch.object(aws_iam.Client, '_update_user_policies')
+    @patch.object(aws_iam.Client, '_create_access_key')
+    def test_rotate_skips_sync_without_drift(
+        self, mk_cak, mk_uup, mk_uugm, mk_fak, mk_cuina
+    ):
+        cli = aws_iam.Client(session=MagicMock())
+        cli._client = MagicMock()
+
+        mk_cuina.return_value = [
+            {'Key': 'managedby', 'Value': 'keydra'},
+            {
+                'Key': aws_iam.FINGERPRINT_TAG,
+                'Value': aws_iam._config_fingerprint(
+                    ['G'], frozenset({'P'}))
+            }
+        ]
+        mk_fak.return_value = {}
+        mk_cak.return_value = {
+            'AccessKeyId': 'KEY_ONE',
+            'SecretAccessKey': 'new_secret'
+        }
+
+        cli.rotate(
+            {
+                'key': 'U',
+                'secret': 'secret',
+                'config': {'groups': ['G'], 'policies': ['P']}
+            }
+        )
+
+        mk_uugm.assert_not_called()
+        mk_uup.assert_not_called()
+        cli._client.tag_user.assert_not_called()
+        mk_cak.assert_called_once_with('U')
+
+    @patch.object(aws_iam.Client, '_get_aws_account_id')
+    @patch.object(aws_iam.Client, '_create_user_if_not_available')
+    @patch.object(aws_iam.Client, '_fetch_access_keys')
+    @patch.object(aws_iam.Client, '_create_access_key')
+    def test_rotate_no_fingerprint_on_failed_sync(
+        self, mk_cak, mk_fak, mk_cuina, gaad
+    ):
+        gaad.return_value = '12345'
+        mk_cuina.return_value = []
+        mk_fak.return_value = {}
+        mk_cak.return_value = {
+            'AccessKeyId': 'KEY_ONE',
+            'SecretAccessKey': 'new_secret'
+        }
+
+        no_such_entity = ClientError(
+            error_response={'Error': {'Code': 'NoSuchEntity'}},
+            operation_name=''
+        )
+
+        for failing in ('add_user_to_group', 'attach_user_policy'):
+            cli = aws_iam.Client(session=MagicMock())
+            cli._client = MagicMock()
+
+            cli._client.get_paginator().paginate().build_full_result \
+                .return_value = {'Groups': [], 'AttachedPolicies': []}
+            getattr(cli._client, failing).side_effect = no_such_entity
+
+            creds = cli.rotate(
+                {
+                    'key': 'U',
+                    'secret': 'secret',
+                    'config': {'groups': ['G'], 'policies': ['P']}
+                }
+            )
+
+            getattr(cli._client, failing).assert_called_once()
+            cli._client.tag_user.assert_not_called()
+            self.assertEqual(creds['key'], 'KEY_ONE')
+
+    @patch.object(aws_iam.Client, '_create_user_if_not_available')
+    @patch.object(aws_iam.Client, '_fetch_access_keys')
+    @patch.object(aws_iam.Client, '_update_user_group_membership')
+    @patch.object(aws_iam.Client, '_update_user_policies')
+    @patch.object(aws_iam.Client, '_create_access_key')
+    def test_rotate_fingerprint_tag_failure_does_not_block(
+        self, mk_cak, mk_uup, mk_uugm, mk_fak, mk_cuina
+    ):
+        cli = aws_iam.Client(session=MagicMock())
+        cli._client = MagicMock()
+
+        mk_cuina.return_value = []
+        mk_fak.return_value = {}
+        mk_uugm.return_value = True
+        mk_uup.return_value = True
+        mk_cak.return_value = {
+            'AccessKeyId': 'KEY_ONE',
+            'SecretAccessKey': 'new_secret'
+        }
+        cli._client.tag_user.side_effect = ClientError(
+            error_response={'Error': {'Code': 'LimitExceeded'}},
+            operation_name='TagUser'
+        )
+
+        creds = cli.rotate({'key': 'U', 'secret': 'secret'})
+
+        cli._client.tag_user.assert_called_once()
+        mk_cak.assert_called_once_with('U')
+        self.assertEqual(creds['key'], 'KEY_ONE')
+
     def test_distribute(self):
         cli = aws_iam.Client(session=MagicMock())
 
@@ -532,3 +783,49 @@ class TestProviderAWSIAM(unittest.TestCase):
 
         r_result = aws_iam.Client.validate_spec(speci_valid)
         self.assertEqual(r_result[0], True)
+
+    @patch.object(aws_iam, '_sts_client')
+    def test__get_aws_account_id_cached(self, sts):
+        aws_iam._resolve_account_id.cache_clear()
+        sts.return_value.get_caller_identity.return_value = {
+            'Account': '12345'}
+
+        session = MagicMock()
+
+        self.assertEqual(
+            aws_iam.Client(session=session)._get_aws_account_id(), '12345')
+        self.assertEqual(
+            aws_iam.Client(session=session)._get_aws_account_id(), '12345')
+
+        sts.assert_called_once_with(session)
+        sts.return_value.get_caller_identity.assert_called_once_with()
+        aws_iam._resolve_account_id.cache_clear()
+
+    def test__init_uses_boto_config(self):
+        session = MagicMock()
+
+        aws_iam.Client(session=session)
+
+        session.client.assert_called_once_with(
+            'iam', config=aws_iam.BOTO_CONFIG)
+
+    def test__sts_client_from_session(self):
+        aws_iam._sts_client.cache_clear()
+        session = MagicMock()
+
+        aws_iam._sts_client(session)
+        aws_iam._sts_client(session)
+
+        session.client.assert_called_once_with(
+            'sts', config=aws_iam.BOTO_CONFIG)
+        aws_iam._sts_client.cache_clear()
+
+    @patch.object(aws_iam.boto3.session, 'Session')
+    def test__init_reuses_default_session(self, session):
+        aws_iam._THREAD_LOCAL.session = None
+
+        aws_iam.Client()
+        aws_iam.Client()
+
+        session.assert_called_once_with()
+        aws_iam._THREAD_LOCAL.session = None